@@ -11,6 +11,12 @@ import argparse
 import shutil
 import subprocess
 import glob
+from pathlib import Path
+import threading
+import collections
+import contextlib
+import functools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import ebooklib
 from ebooklib import epub
 from bs4 import BeautifulSoup
@@ -18,6 +24,9 @@ import httpx
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import letter
 from PIL import Image
+from leases import (CHAPTERS_COMPLETE_MARKER, DOWNLOADING_MARKER, LEASE_DIR, MERGED_MARKER, TRANSCODED_LIST,
+                    TRANSCODING_MARKER, ActivityMarker, LeaseManager, is_book_finished, is_transcoding_consistent,
+                    live_markers, mark_merged, merge_key, merged_outputs)
 
 UA = {
     1: "Samsung/Galaxy_A51 Android/12 Bookmate/3.7.3",
@@ -46,6 +55,17 @@ HEADERS = {
     'accept-encoding': '',
     'user-agent': ''
 }
+# Smaller EPUBs are converted inline: starting worker processes costs more than it saves
+PARALLEL_CONVERSION_MIN_BYTES = 512 * 1024
+# ffmpeg encoder options for --transcode; chapters stay in an MP4 container so the merge is unchanged
+TRANSCODE_CODECS = {
+    'aac-he': ['-c:a', 'libfdk_aac', '-profile:a', 'aac_he'],
+    'opus': ['-c:a', 'libopus'],
+}
+# --stream fetches this many chapters one by one at full bandwidth before going parallel
+STREAM_PRIORITY_CHAPTERS = 2
+# Length of the HLS segments written by --stream, in seconds
+STREAM_SEGMENT_SECONDS = 10
 BASE_URL = "https://api.bookmate.yandex.net/api/v5"
 URLS = {
     "book": {
@@ -108,33 +128,385 @@ def replace_forbidden_chars(filename):
     return re.sub(f'[{chars}]', '', filename)
 
 
+def format_size(num_bytes):
+    for unit in ['B', 'KB', 'MB']:
+        if num_bytes < 1024:
+            return f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} GB"
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes:02d}:{seconds:02d}"
+
+
+class TransferProgress:
+    """
+    Aggregate progress of all file transfers
+
+    Tracks bytes done/total per transfer and overall, current (sliding window) and
+    average throughput, active transfers, queue depth and ETA. On a TTY the status is
+    redrawn in place on a single line, otherwise a summary line is printed every
+    `interval` seconds. A background ticker keeps rendering while transfers are active,
+    so a stalled download shows up as such instead of going silent.
+    """
+
+    def __init__(self, stream=None, interval=None, window=5.0):
+        self.stream = stream or sys.stdout
+        self.is_tty = hasattr(self.stream, 'isatty') and self.stream.isatty()
+        self.interval = interval if interval is not None else (0.2 if self.is_tty else 10.0)
+        self.window = window
+        self.lock = threading.RLock()
+        self.ticker = None
+        self.reset()
+
+    def reset(self):
+        self.transfers = {}  # file path -> [bytes done, bytes total or None]
+        self.queued = 0
+        self.completed = 0
+        self.completed_bytes = 0
+        self.transferred = 0
+        self.started_at = None
+        self.samples = collections.deque()  # (time, bytes transferred), recorded as bytes arrive
+        self.last_progress_at = None
+        self.last_render = 0.0
+        self.line_width = 0
+
+    def enqueue(self, count=1):
+        """Announce transfers that will start later (or withdraw them with a negative count)"""
+        with self.lock:
+            self.queued = max(0, self.queued + count)
+            self._render()
+
+    def start(self, name, total=None):
+        with self.lock:
+            if self.started_at is None:
+                self.started_at = time.monotonic()
+                self.last_progress_at = self.started_at
+                self._sample(self.started_at)
+            self._start_ticker()
+            if name not in self.transfers:
+                self.queued = max(0, self.queued - 1)
+            # A retried transfer starts over from zero
+            self.transfers[name] = [0, total]
+            self._render(force=True)
+
+    def update(self, name, num_bytes):
+        with self.lock:
+            self.transfers[name][0] += num_bytes
+            self.transferred += num_bytes
+            self.last_progress_at = time.monotonic()
+            self._sample(self.last_progress_at)
+            self._render()
+
+    def finish(self, name, ok=True):
+        with self.lock:
+            transfer = self.transfers.pop(name, None)
+            if transfer and ok:
+                self.completed += 1
+                self.completed_bytes += transfer[0]
+            if self.transfers or self.queued:
+                self._render(force=True)
+            else:
+                self._clear()
+
+    def log(self, message):
+        """Print a message above the status line without garbling it"""
+        with self.lock:
+            self._clear()
+            print(message, file=self.stream, flush=True)
+            if self.transfers or self.queued:
+                self._render(force=True)
+
+    def close(self):
+        """Print a final summary of the transfers since the last close and start over"""
+        with self.lock:
+            self._clear()
+            if self.completed and self.started_at is not None:
+                elapsed = max(time.monotonic() - self.started_at, 1e-6)
+                print(f"⬇️ Downloaded {self.completed} files, {format_size(self.completed_bytes)} "
+                      f"in {format_duration(elapsed)} (avg {format_size(self.transferred / elapsed)}/s)",
+                      file=self.stream, flush=True)
+            self.reset()
+
+    def status_line(self):
+        now = time.monotonic()
+        active = list(self.transfers.values())
+        done = self.completed_bytes + sum(t[0] for t in active)
+
+        # Size of transfers that have not reported one yet is estimated from the known ones
+        known_sizes = [t[1] for t in active if t[1]]
+        if self.completed:
+            average_size = self.completed_bytes / self.completed
+        elif known_sizes:
+            average_size = sum(known_sizes) / len(known_sizes)
+        else:
+            average_size = None
+        remaining = sum(t[1] - t[0] for t in active if t[1])
+        total_known = average_size is not None or not (self.queued or any(not t[1] for t in active))
+        if average_size is not None:
+            remaining += average_size * (self.queued + sum(1 for t in active if not t[1]))
+        total = done + remaining
+
+        self._sample(now)
+        first_time, first_bytes = self.samples[0]
+        current_rate = (self.transferred - first_bytes) / (now - first_time) if now > first_time else 0.0
+        stalled = now - self.last_progress_at if self.last_progress_at is not None else 0.0
+        elapsed = now - self.started_at if self.started_at is not None else 0.0
+        average_rate = self.transferred / elapsed if elapsed > 0 else 0.0
+
+        files_total = self.completed + len(active) + self.queued
+        parts = [f"{self.completed}/{files_total} files"]
+        parts.append(f"{format_size(done)}/{format_size(total)}" if total_known else format_size(done))
+        parts.append(f"{format_size(current_rate)}/s (avg {format_size(average_rate)}/s)")
+        parts.append(f"active {len(active)}")
+        parts.append(f"queued {self.queued}")
+        if active and stalled >= self.window:
+            parts.append(f"no data for {format_duration(stalled)}")
+        rate = current_rate or average_rate
+        if total_known and rate > 0:
+            parts.append(f"ETA {format_duration(remaining / rate)}")
+        return "⬇️ " + " | ".join(parts)
+
+    def _sample(self, now):
+        # Keep the newest sample older than the window as the base, so the current rate always
+        # spans at least `window` seconds, however long the render interval is
+        if not self.samples or now - self.samples[-1][0] >= 0.1:
+            self.samples.append((now, self.transferred))
+        while len(self.samples) > 1 and now - self.samples[1][0] >= self.window:
+            self.samples.popleft()
+
+    def _start_ticker(self):
+        if self.ticker is None:
+            self.ticker = threading.Thread(target=self._tick, name="progress-ticker", daemon=True)
+            self.ticker.start()
+
+    def _tick(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if self.transfers:
+                    self._render()
+
+    def _render(self, force=False):
+        now = time.monotonic()
+        if self.started_at is None:
+            return
+        # Forced redraws only make sense in place; a log keeps its fixed cadence
+        if (not force or not self.is_tty) and now - self.last_render < self.interval:
+            return
+        self.last_render = now
+        line = self.status_line()
+        if self.is_tty:
+            self.stream.write("\r" + line.ljust(self.line_width))
+            self.stream.flush()
+            self.line_width = len(line)
+        else:
+            print(line, file=self.stream, flush=True)
+
+    def _clear(self):
+        if self.is_tty and self.line_width:
+            self.stream.write("\r" + " " * self.line_width + "\r")
+            self.stream.flush()
+            self.line_width = 0
+
+
+PROGRESS = TransferProgress()
+
+
+def peak_rss():
+    """Peak resident set size of this process and of its finished children, in bytes"""
+    try:
+        import resource
+    except ImportError:
+        # Not available on Windows
+        return None, None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+
+class StageProfiler:
+    """
+    Wall time, CPU time and peak RSS growth per pipeline stage (enabled with --profile)
+
+    CPU time is split between this process and its child processes (ffprobe, ffmpeg,
+    conversion workers); children are only accounted once they have exited. The OS only
+    keeps the lifetime peak RSS, so a stage is charged with how far it raised that peak:
+    0 means it stayed within memory an earlier stage had already used. For children the
+    peak is that of the largest child so far. Stages may nest or overlap, so their numbers
+    are not meant to add up to the total. One stage can additionally be run under cProfile
+    and its stats dumped to a file. cProfile only sees the thread it was enabled in, so
+    every thread running the stage gets its own profiler and their stats are merged; on
+    Python 3.12+ only one profiler can be active at a time, so concurrent runs of the stage
+    on other threads are left out and counted in the report.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.profile_stage = None
+        self.profile_output = None
+        self.profilers = {}  # thread id -> [cProfile.Profile, nesting depth]
+        self.unprofiled_runs = 0
+        self.started_at = time.perf_counter()
+
+    def enable(self, profile_stage=None, profile_output=None):
+        self.enabled = True
+        self.profile_stage = profile_stage
+        if profile_stage and not profile_output:
+            profile_output = "profile_" + re.sub(r'\W+', '_', profile_stage) + ".pstats"
+        self.profile_output = profile_output
+        self.started_at = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        profiling = name == self.profile_stage and self._start_cprofile()
+        start_wall = time.perf_counter()
+        start_times = os.times()
+        start_rss, start_child_rss = peak_rss()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start_wall
+            end_times = os.times()
+            if profiling:
+                self._stop_cprofile()
+            rss, child_rss = peak_rss()
+            with self.lock:
+                stats = self.stats.setdefault(name, {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'child_cpu': 0.0,
+                                                     'rss': None, 'child_rss': None})
+                stats['calls'] += 1
+                stats['wall'] += wall
+                stats['cpu'] += (end_times.user - start_times.user) + (end_times.system - start_times.system)
+                stats['child_cpu'] += (end_times.children_user - start_times.children_user) \
+                    + (end_times.children_system - start_times.children_system)
+                if rss is not None:
+                    stats['rss'] = max(stats['rss'] or 0, rss - start_rss)
+                    stats['child_rss'] = max(stats['child_rss'] or 0, child_rss - start_child_rss)
+
+    def _start_cprofile(self):
+        """Profile the calling thread; returns False if this run cannot be profiled"""
+        import cProfile
+        with self.lock:
+            entry = self.profilers.setdefault(threading.get_ident(), [None, 0])
+            if entry[1] == 0:
+                profiler = entry[0] or cProfile.Profile()
+                try:
+                    profiler.enable()
+                except ValueError:
+                    # Python 3.12+: another thread's profiler is active
+                    self.unprofiled_runs += 1
+                    return False
+                entry[0] = profiler
+            entry[1] += 1
+            return True
+
+    def _stop_cprofile(self):
+        with self.lock:
+            entry = self.profilers[threading.get_ident()]
+            entry[1] -= 1
+            if entry[1] == 0:
+                entry[0].disable()
+
+    def report(self):
+        if not self.enabled:
+            return
+        import pstats
+        total = time.perf_counter() - self.started_at
+        rss, child_rss = peak_rss()
+        peak = f", peak RSS {format_size(rss)}, largest child {format_size(child_rss)}" if rss is not None else ""
+        print(f"\n⏱️ Profile (total wall time {total:.2f} s{peak})")
+        print(f"{'Stage':<24}{'Calls':>7}{'Wall s':>10}{'Wall %':>8}{'CPU s':>9}{'Child CPU s':>13}"
+              f"{'Peak RSS +':>12}{'Child peak +':>14}")
+        for name, stats in self.stats.items():
+            rss = format_size(stats['rss']) if stats['rss'] is not None else '-'
+            child_rss = format_size(stats['child_rss']) if stats['child_rss'] is not None else '-'
+            share = stats['wall'] / total * 100 if total > 0 else 0.0
+            print(f"{name:<24}{stats['calls']:>7}{stats['wall']:>10.2f}{share:>7.1f}%{stats['cpu']:>9.2f}"
+                  f"{stats['child_cpu']:>13.2f}{rss:>12}{child_rss:>14}")
+        profilers = [profiler for profiler, _ in self.profilers.values() if profiler]
+        if profilers:
+            profile_stats = pstats.Stats(*profilers)
+            profile_stats.dump_stats(self.profile_output)
+            print(f"\ncProfile stats for stage '{self.profile_stage}' from {len(profilers)} thread(s) "
+                  f"saved to {self.profile_output}")
+            if self.unprofiled_runs:
+                print(f"⚠️ {self.unprofiled_runs} run(s) overlapping on other threads were not profiled: "
+                      f"this Python allows one active profiler at a time")
+            profile_stats.sort_stats('cumulative').print_stats(15)
+        elif self.profile_stage:
+            print(f"\n⚠️ Stage '{self.profile_stage}' never ran, no cProfile stats written")
+
+
+PROFILER = StageProfiler()
+# Coordinates workers sharing one library; disabled (every claim succeeds) unless --shared
+LEASES = LeaseManager()
+
+
+def exclusive(resource_type):
+    """Skip a download when another worker has already claimed the same resource"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(uuid, *args, **kwargs):
+            with LEASES.claim(f"{resource_type}-{uuid}") as claimed:
+                if not claimed:
+                    PROGRESS.log(f"⏭️ {resource_type} {uuid} is being downloaded by another worker, skipping")
+                    return None
+                return func(uuid, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+async def save_response(response, file_path):
+    # Stream into a temporary file so an interrupted transfer never looks like a finished one
+    total = response.headers.get('content-length')
+    PROGRESS.start(file_path, int(total) if total and total.isdigit() else None)
+    part_path = f"{file_path}.part"
+    downloaded = 0
+    with open(part_path, 'wb') as file:
+        async for chunk in response.aiter_bytes():
+            file.write(chunk)
+            PROGRESS.update(file_path, response.num_bytes_downloaded - downloaded)
+            downloaded = response.num_bytes_downloaded
+    os.replace(part_path, file_path)
+    PROGRESS.log(f"File downloaded successfully to {file_path}")
+    return True
+
+
 async def download_file(url, file_path):
     is_download = False
     count = 0
-    while not is_download:
-        async with httpx.AsyncClient(http2=True, verify=False) as client:
-            response = await client.get(url, headers=HEADERS, timeout=None)
-            if response.status_code == 200:
-                is_download = True
-                with open(file_path, 'wb') as file:
-                    file.write(response.content)
-                print(f"File downloaded successfully to {file_path}")
-            elif response.is_redirect:
-                response = await client.get(response.next_request.url)
-                if response.status_code == 200:
-                    is_download = True
-                    with open(file_path, 'wb') as file:
-                        file.write(response.content)
-                    print(f"File downloaded successfully to {file_path}")
-            else:
-                print(
-                    f"Failed to download file. Status code: {response.status_code}")
-                count += 1
-                if count == 3:
-                    print(
-                        "Failed to download the file check if the id is correct or try again later")
-                    sys.exit()
-                time.sleep(5)
+    with PROFILER.stage('transfer'):
+        try:
+            while not is_download:
+                async with httpx.AsyncClient(http2=True, verify=False) as client:
+                    async with client.stream('GET', url, headers=HEADERS, timeout=None) as response:
+                        if response.status_code == 200:
+                            is_download = await save_response(response, file_path)
+                        elif response.is_redirect:
+                            async with client.stream('GET', response.next_request.url, timeout=None) as redirected:
+                                if redirected.status_code == 200:
+                                    is_download = await save_response(redirected, file_path)
+                        else:
+                            PROGRESS.log(
+                                f"Failed to download file. Status code: {response.status_code}")
+                            count += 1
+                            if count == 3:
+                                PROGRESS.log(
+                                    "Failed to download the file check if the id is correct or try again later")
+                                sys.exit()
+                            await asyncio.sleep(5)
+        finally:
+            PROGRESS.finish(file_path, ok=is_download)
 
 
 async def send_request(url):
@@ -157,6 +529,7 @@ async def send_request(url):
                 time.sleep(5)
 
 
+@PROFILER.stage('pdf assembly')
 def create_pdf_from_images(images_folder, output_pdf):
     c = canvas.Canvas(output_pdf, pagesize=letter)
     width, height = letter
@@ -173,18 +546,32 @@ def create_pdf_from_images(images_folder, output_pdf):
     print(f"File downloaded successfully to {output_pdf}")
 
 
-def epub_to_fb2(epub_path, fb2_path):
+def html_to_text(content):
+    soup = BeautifulSoup(content, 'html.parser')
+    return soup.get_text()
+
+
+@PROFILER.stage('epub to fb2')
+def epub_to_fb2(epub_path, fb2_path, workers=None):
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
         book = epub.read_epub(epub_path)
 
+    documents = [item.get_content() for item in book.get_items()
+                 if item.get_type() == ebooklib.ITEM_DOCUMENT]
+
+    # Parse documents on all cores; map() keeps the results in document order
+    workers = min(workers or os.cpu_count() or 1, len(documents))
+    if workers > 1 and sum(map(len, documents)) >= PARALLEL_CONVERSION_MIN_BYTES:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            texts = list(executor.map(html_to_text, documents,
+                                      chunksize=max(1, len(documents) // (workers * 4))))
+    else:
+        texts = [html_to_text(content) for content in documents]
+
     fb2_content = '<?xml version="1.0" encoding="UTF-8"?>\n<fb2 xmlns="http://www.gribuser.ru/xml/fictionbook/2.0" xmlns:l="http://www.w3.org/1999/xlink">\n<body>'
-    for item in book.get_items():
-        if item.get_type() == ebooklib.ITEM_DOCUMENT:
-            content = item.get_content()
-            soup = BeautifulSoup(content, 'html.parser')
-            text_content = soup.get_text()
-            fb2_content += f'<p>{text_content}</p>'
+    for text_content in texts:
+        fb2_content += f'<p>{text_content}</p>'
 
     fb2_content += '</body>\n</fb2>'
 
@@ -196,7 +583,8 @@ def epub_to_fb2(epub_path, fb2_path):
 
 def get_resource_info(resource_type, uuid, series=''):
     info_url = URLS[resource_type]['infoUrl'].format(uuid=uuid)
-    info = asyncio.run(send_request(info_url)).json()
+    with PROFILER.stage('metadata'):
+        info = asyncio.run(send_request(info_url)).json()
     if info:
         picture_url = info[resource_type]["cover"]["large"]
         name = info[resource_type]["title"]
@@ -207,68 +595,281 @@ def get_resource_info(resource_type, uuid, series=''):
         asyncio.run(download_file(picture_url, f'{path}.jpeg'))
         with open(f"{path}.json", 'w', encoding='utf-8') as file:
             file.write(json.dumps(info, ensure_ascii=False))
-        print(f"File downloaded successfully to {path}.json")
+        PROGRESS.log(f"File downloaded successfully to {path}.json")
     return path
 
 
 def get_resource_json(resource_type, uuid):
     url = URLS[resource_type]['contentUrl'].format(uuid=uuid)
-    return asyncio.run(send_request(url)).json()
+    with PROFILER.stage('metadata'):
+        return asyncio.run(send_request(url)).json()
 
 
-def download_book(uuid, series='', serial_path=None):
+@exclusive('book')
+def download_book(uuid, series='', serial_path=None, executor=None):
     path = serial_path if serial_path else get_resource_info(
         'book', uuid, series)
     asyncio.run(download_file(
         URLS['book']['contentUrl'].format(uuid=uuid), f'{path}.epub'))
+    if executor:
+        # The caller's pool already spreads books over the cores, so convert each one serially
+        return executor.submit(epub_to_fb2, f"{path}.epub", f"{path}.fb2", 1)
     epub_to_fb2(f"{path}.epub", f"{path}.fb2")
 
 
-def merge_audiobook_chapters_ffmpeg(audiobook_dir, output_file, metadata=None, cleanup_chapters=True):
+class ChapterTranscoder:
     """
-    Merge all M4A chapter files in a directory into a single audiobook using ffmpeg
-    
-    Args:
-        audiobook_dir: Path to the directory containing chapter files
-        output_file: Path for the merged output file
-        metadata: Dictionary of metadata to embed
-        cleanup_chapters: Whether to remove individual chapter files after successful merge
+    Re-encode downloaded chapters to a compact codec on a pool of ffmpeg workers
+
+    Chapters are submitted as soon as they are downloaded, so encoding overlaps with the
+    remaining downloads. Each ffmpeg runs single-threaded and there is one worker per core.
+    A chapter is replaced only after it was encoded successfully.
     """
-    from pathlib import Path
-    import subprocess
-    
-    audiobook_path = Path(audiobook_dir)
-    
-    # Find all M4A files and sort them naturally
-    chapter_files = sorted([f for f in audiobook_path.glob("*.m4a") if "Глава_" in f.name], 
-                          key=lambda x: int(x.stem.split('_')[1]))
-    
-    if not chapter_files:
-        print(f"No chapter files found in {audiobook_path}")
-        return False
-    
-    print(f"Found {len(chapter_files)} chapters, merging with ffmpeg...")
-    
-    # Look for cover image
-    cover_image = None
-    for ext in ['.jpeg', '.jpg', '.png']:
-        potential_cover = audiobook_path / f"{audiobook_path.name}{ext}"
-        if potential_cover.exists():
-            cover_image = potential_cover
-            break
-    
-    # Create a temporary file list for ffmpeg
-    filelist_path = audiobook_path / "chapters_list.txt"
-    
-    # Create chapter metadata file
-    chapters_metadata_path = audiobook_path / "chapters_metadata.txt"
-    
-    try:
-        # Get chapter durations first
-        print("📊 Analyzing chapter durations...")
-        chapter_durations = []
-        current_time = 0.0
-        
+
+    def __init__(self, audiobook_dir, codec, bitrate, workers=None):
+        self.audiobook_dir = audiobook_dir
+        self.codec = codec
+        self.bitrate = bitrate
+        self.executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+        self.futures = []
+        self.lock = threading.Lock()
+        self.transcoded_list = os.path.join(audiobook_dir, TRANSCODED_LIST)
+        # Tells the merge watcher to hold off until close(), or until this process is gone
+        self.transcoding_marker = ActivityMarker(audiobook_dir, TRANSCODING_MARKER)
+
+    @staticmethod
+    def is_available(codec):
+        """Whether ffmpeg is installed and built with the encoder `codec` needs"""
+        encoder = TRANSCODE_CODECS[codec][1]
+        try:
+            result = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'], capture_output=True, text=True,
+                                    encoding='utf-8', errors='replace')
+        except OSError:
+            return False
+        return result.returncode == 0 and any(line.split()[1:2] == [encoder] for line in result.stdout.splitlines())
+
+    def is_transcoded(self, name):
+        # Re-read every time: other workers sharing the book append to the same list
+        if not os.path.exists(self.transcoded_list):
+            return False
+        with self.lock, open(self.transcoded_list, encoding='utf-8') as file:
+            return any(line.split()[0] == name for line in file if line.strip())
+
+    def submit(self, name, lease_key=None):
+        """Queue a chapter; `lease_key` is released once the chapter is done"""
+        if self.is_transcoded(name):
+            LEASES.release(lease_key)
+            return
+        self.futures.append(self.executor.submit(self.transcode, name, lease_key))
+
+    def transcode(self, name, lease_key=None):
+        try:
+            return self._transcode(name, lease_key)
+        finally:
+            LEASES.release(lease_key)
+
+    def _transcode(self, name, lease_key=None):
+        chapter_file = os.path.join(self.audiobook_dir, name)
+        temp_file = f"{chapter_file}.transcode"
+        cmd = [
+            'ffmpeg', '-y', '-v', 'error',
+            '-i', chapter_file,
+            '-map', '0:a',
+            *TRANSCODE_CODECS[self.codec],
+            '-b:a', self.bitrate,
+            '-threads', '1',
+            '-f', 'mp4',
+            temp_file
+        ]
+        original_size = os.path.getsize(chapter_file)
+        error = None
+        with PROFILER.stage('transcode'):
+            try:
+                result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8', errors='replace')
+                if result.returncode != 0:
+                    error = (result.stderr.strip().splitlines()[-1:] or ['unknown error'])[0]
+            except OSError as e:
+                # ffmpeg went missing after the availability check
+                error = str(e)
+        if error:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            PROGRESS.log(f"⚠️ Could not transcode {name}, keeping the original: {error}")
+            return False
+        if lease_key and not LEASES.holds(lease_key):
+            # Another worker took the chapter over and may be encoding it too; leave it to them
+            os.remove(temp_file)
+            PROGRESS.log(f"⚠️ Lost the claim on {name}, discarding its transcoded copy")
+            return True
+        os.replace(temp_file, chapter_file)
+        with self.lock:
+            with open(self.transcoded_list, 'a', encoding='utf-8') as file:
+                file.write(f"{name} {self.codec} {self.bitrate}\n")
+        PROGRESS.log(f"🎛️ Transcoded {name} to {self.codec} {self.bitrate}: "
+                     f"{format_size(original_size)} → {format_size(os.path.getsize(chapter_file))}")
+        return True
+
+    def wait(self):
+        """Wait for all submitted chapters; returns True if every one was transcoded"""
+        return all([future.result() for future in self.futures])
+
+    def close(self):
+        """Drop chapters not started yet, wait for running ones and remove the marker"""
+        self.executor.shutdown(cancel_futures=True)
+        self.transcoding_marker.close()
+
+
+class HlsStream:
+    """
+    Growing HLS playlist of an audiobook that is still downloading
+
+    Every chapter is remuxed without re-encoding into short MPEG-TS segments that ffmpeg
+    appends to an EVENT playlist in stream/, so a player can start as soon as the first
+    chapter lands and picks up new segments as it reloads. Chapters are appended strictly
+    in listening order; one that arrives early waits for its predecessors.
+    #EXT-X-ENDLIST is written with the last chapter.
+    """
+
+    def __init__(self, audiobook_dir, chapter_names):
+        self.audiobook_dir = audiobook_dir
+        self.stream_dir = os.path.join(audiobook_dir, "stream")
+        self.playlist_path = os.path.join(self.stream_dir, "playlist.m3u8")
+        self.chapter_names = chapter_names
+        self.ready = set()
+        self.appended = 0
+        self.disabled = False
+        # Created inside the running event loop
+        self.lock = None
+        # Rebuilt from scratch: appending to a playlist from an interrupted run would repeat chapters
+        shutil.rmtree(self.stream_dir, ignore_errors=True)
+        os.makedirs(self.stream_dir)
+        PROGRESS.log(f"▶️ Streaming playlist (open it in VLC, mpv or Safari): {self.playlist_path}")
+
+    async def add(self, name):
+        self.ready.add(name)
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            while not self.disabled and self.appended < len(self.chapter_names) \
+                    and self.chapter_names[self.appended] in self.ready:
+                await asyncio.to_thread(self._append, self.chapter_names[self.appended],
+                                        self.appended == len(self.chapter_names) - 1)
+                self.appended += 1
+
+    def _append(self, name, last):
+        flags = 'append_list+discont_start' if last else 'append_list+discont_start+omit_endlist'
+        cmd = [
+            'ffmpeg', '-y', '-v', 'error',
+            '-i', os.path.abspath(os.path.join(self.audiobook_dir, name)),
+            '-map', '0:a',
+            '-c:a', 'copy',
+            '-f', 'hls',
+            '-hls_time', str(STREAM_SEGMENT_SECONDS),
+            '-hls_list_size', '0',
+            '-hls_playlist_type', 'event',
+            '-hls_flags', flags,
+            '-hls_segment_filename', f"{os.path.splitext(name)[0]}_%04d.ts",
+            os.path.basename(self.playlist_path)
+        ]
+        try:
+            with PROFILER.stage('stream remux'):
+                # Run inside stream/ so the playlist refers to segments by their plain names
+                result = subprocess.run(cmd, cwd=self.stream_dir, capture_output=True, text=True,
+                                        encoding='utf-8', errors='replace')
+        except OSError as e:
+            result = None
+            error = str(e)
+        else:
+            error = (result.stderr.strip().splitlines() or ['unknown error'])[-1]
+        if result is None or result.returncode != 0:
+            self.disabled = True
+            PROGRESS.log(f"⚠️ Could not add {name} to the streaming playlist, streaming stopped: {error}")
+            return
+        PROGRESS.log(f"▶️ {name} is playable in {self.playlist_path}")
+
+
+def chapter_lease_key(uuid, name):
+    return f"audiobook-{uuid}-{name}"
+
+
+def wait_for_other_workers(uuid, audiobook_dir, chapter_names):
+    """Wait until no other worker sharing the library still downloads or transcodes a chapter of the book"""
+    while True:
+        busy = [name for name in chapter_names if LEASES.is_held_elsewhere(chapter_lease_key(uuid, name))]
+        transcoding = live_markers(audiobook_dir, TRANSCODING_MARKER)
+        if not busy and not transcoding:
+            return
+        PROGRESS.log(f"⏳ Waiting for other workers to finish {len(busy)} chapters "
+                     f"({len(transcoding)} still transcoding)...")
+        time.sleep(5)
+
+
+async def fetch_chapters(uuid, tracks, audiobook_dir, bitrate, files, transcoder=None, stream=None,
+                         parallel=1, priority=0):
+    """
+    Download the missing chapters of an audiobook
+
+    The first `priority` chapters are fetched one at a time so they get the full bandwidth,
+    the rest with up to `parallel` downloads at once. Every chapter is claimed before it is
+    fetched, so workers sharing the library split a book between them; chapters claimed
+    elsewhere are revisited until they show up. Returns False if another worker finished
+    the book first, in which case the chapters it removed after merging are not fetched again.
+    """
+    semaphore = asyncio.Semaphore(parallel)
+
+    async def fetch(track):
+        name = f'Глава_{track["number"]+1}.m4a'
+        chapter_file = f'{audiobook_dir}/{name}'
+        chapter_key = chapter_lease_key(uuid, name)
+        # Claim only when a download slot is free, so one worker does not hoard the book
+        async with semaphore:
+            if os.path.exists(chapter_file):
+                if name not in files:
+                    # Downloaded by another worker meanwhile
+                    files.append(name)
+                    PROGRESS.enqueue(-1)
+                # Chapters left over from an interrupted run
+                if transcoder and await asyncio.to_thread(LEASES.try_acquire, chapter_key):
+                    transcoder.submit(name, chapter_key)
+            # Claiming lists the shared lease directory and may back off, so it runs off the event loop
+            elif not await asyncio.to_thread(LEASES.try_acquire, chapter_key):
+                return False
+            elif LEASES.enabled and is_book_finished(audiobook_dir):
+                LEASES.release(chapter_key)
+                return None
+            else:
+                download_url = track['offline'][bitrate]['url'].replace(".m3u8", ".m4a")
+                try:
+                    await download_file(download_url, chapter_file)
+                except BaseException:
+                    LEASES.release(chapter_key)
+                    raise
+                files.append(name)
+                if transcoder:
+                    transcoder.submit(name, chapter_key)
+                else:
+                    LEASES.release(chapter_key)
+        if stream:
+            await stream.add(name)
+        return True
+
+    pending = list(tracks)
+    while pending:
+        fetched = [await fetch(track) for track in pending[:priority]]
+        fetched += await asyncio.gather(*(fetch(track) for track in pending[priority:]))
+        if None in fetched:
+            return False
+        deferred = [track for track, ok in zip(pending, fetched) if not ok]
+        if deferred:
+            PROGRESS.log(f"⏳ Waiting for {len(deferred)} chapters claimed by other workers...")
+            await asyncio.sleep(5)
+        pending = deferred
+    return True
+
+
+def probe_chapter_durations(chapter_files):
+    durations = []
+    with PROFILER.stage('ffprobe'):
         for chapter_file in chapter_files:
             # Get duration of each chapter using ffprobe
             duration_cmd = [
@@ -278,14 +879,56 @@ def merge_audiobook_chapters_ffmpeg(audiobook_dir, output_file, metadata=None, c
             duration_result = subprocess.run(duration_cmd, capture_output=True, text=True)
             
             if duration_result.returncode == 0:
-                duration = float(duration_result.stdout.strip())
-                chapter_durations.append((current_time, current_time + duration, chapter_file))
-                current_time += duration
+                durations.append(float(duration_result.stdout.strip()))
             else:
                 print(f"⚠️ Could not get duration for {chapter_file.name}")
-                chapter_durations.append((current_time, current_time + 180, chapter_file))  # Fallback: 3 minutes
-                current_time += 180
-        
+                durations.append(180)  # Fallback: 3 minutes
+    return durations
+
+
+def split_chapters_into_parts(chapter_files, durations, max_part_hours=None, max_part_mb=None):
+    """
+    Group consecutive chapters into parts at chapter boundaries
+
+    A new part starts whenever adding the next chapter would exceed the maximum duration
+    or size; a single chapter longer than the limit becomes a part of its own.
+    Returns a list of lists of chapter indices.
+    """
+    max_seconds = max_part_hours * 3600 if max_part_hours else None
+    max_bytes = max_part_mb * 1024 * 1024 if max_part_mb else None
+    parts = [[]]
+    part_seconds = 0.0
+    part_bytes = 0
+    for index, (chapter_file, duration) in enumerate(zip(chapter_files, durations)):
+        size = chapter_file.stat().st_size
+        too_long = max_seconds and part_seconds + duration > max_seconds
+        too_big = max_bytes and part_bytes + size > max_bytes
+        if parts[-1] and (too_long or too_big):
+            parts.append([])
+            part_seconds = 0.0
+            part_bytes = 0
+        parts[-1].append(index)
+        part_seconds += duration
+        part_bytes += size
+    return parts
+
+
+def mux_audiobook(chapter_files, durations, chapter_numbers, output_file, metadata=None, cover_image=None,
+                  fallback_title='', temp_suffix=''):
+    """
+    Concatenate chapter files into one M4A/M4B with chapter markers using ffmpeg
+
+    Chapter markers start at zero for the first of the given chapters. Returns the
+    finished ffmpeg process.
+    """
+    output_path = Path(output_file)
+    # Create a temporary file list for ffmpeg
+    filelist_path = output_path.parent / f"chapters_list{temp_suffix}.txt"
+    
+    # Create chapter metadata file
+    chapters_metadata_path = output_path.parent / f"chapters_metadata{temp_suffix}.txt"
+    
+    try:
         # Write file list for ffmpeg concat
         with open(filelist_path, 'w', encoding='utf-8') as f:
             for chapter_file in chapter_files:
@@ -306,8 +949,9 @@ def merge_audiobook_chapters_ffmpeg(audiobook_dir, output_file, metadata=None, c
                         f.write(f"{key.upper()}={escaped_value}\n")
             
             # Add chapter markers
-            for i, (start_time, end_time, chapter_file) in enumerate(chapter_durations):
-                chapter_num = i + 1
+            start_time = 0.0
+            for chapter_num, duration in zip(chapter_numbers, durations):
+                end_time = start_time + duration
                 chapter_title = f"Глава {chapter_num}"
                 
                 f.write("\n[CHAPTER]\n")
@@ -315,6 +959,7 @@ def merge_audiobook_chapters_ffmpeg(audiobook_dir, output_file, metadata=None, c
                 f.write(f"START={int(start_time * 1000)}\n")
                 f.write(f"END={int(end_time * 1000)}\n")
                 f.write(f"title={chapter_title}\n")
+                start_time = end_time
         
         # FFmpeg command to concatenate files
         cmd = [
@@ -343,43 +988,17 @@ def merge_audiobook_chapters_ffmpeg(audiobook_dir, output_file, metadata=None, c
                     cmd.extend(['-metadata', f'{key}={value}'])
         else:
             # Fallback metadata
-            cmd.extend(['-metadata', f'title={audiobook_path.name}'])
+            cmd.extend(['-metadata', f'title={fallback_title}'])
             cmd.extend(['-metadata', 'genre=Audiobook'])
             cmd.extend(['-metadata', 'media_type=2'])
         
+        # ffmpeg picks its ipod muxer for .m4a, which cannot hold chapters transcoded to Opus
+        cmd.extend(['-f', 'mp4'])
         cmd.append(str(output_file))
         
         # Run ffmpeg
-        result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8', errors='replace')
-        
-        if result.returncode == 0:
-            print(f"✅ Successfully merged audiobook: {output_file}")
-            # Get file size
-            size_mb = Path(output_file).stat().st_size / (1024 * 1024)
-            print(f"Output file size: {size_mb:.1f} MB")
-            if cover_image:
-                print(f"📷 Cover image embedded: {cover_image.name}")
-            print(f"📑 Chapter markers added: {len(chapter_files)} chapters")
-            
-            # Clean up individual chapter files after successful merge (if requested)
-            if cleanup_chapters:
-                print("🧹 Cleaning up chapter files...")
-                for chapter_file in chapter_files:
-                    try:
-                        chapter_file.unlink()
-                        print(f"   Removed: {chapter_file.name}")
-                    except OSError as e:
-                        print(f"   ⚠️ Could not remove {chapter_file.name}: {e}")
-                
-                print(f"✨ Cleanup complete. Merged audiobook ready: {Path(output_file).name}")
-            else:
-                print(f"📁 Chapter files preserved. Merged audiobook ready: {Path(output_file).name}")
-            
-            return True
-        else:
-            print(f"❌ Error merging audiobook with ffmpeg:")
-            print(result.stderr)
-            return False
+        with PROFILER.stage('ffmpeg concat'):
+            return subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8', errors='replace')
             
     finally:
         # Clean up temporary files
@@ -389,81 +1008,266 @@ def merge_audiobook_chapters_ffmpeg(audiobook_dir, output_file, metadata=None, c
             chapters_metadata_path.unlink()
 
 
-def download_audiobook(uuid, series='', max_bitrate=False, merge_chapters=True, cleanup_chapters=True):
+def merge_audiobook_chapters_ffmpeg(audiobook_dir, output_file, metadata=None, cleanup_chapters=True,
+                                    max_part_hours=None, max_part_mb=None):
+    """
+    Merge all M4A chapter files in a directory into a single audiobook using ffmpeg
+    
+    Args:
+        audiobook_dir: Path to the directory containing chapter files
+        output_file: Path for the merged output file
+        metadata: Dictionary of metadata to embed
+        cleanup_chapters: Whether to remove individual chapter files after successful merge
+        max_part_hours: Split into parts of at most this many hours, at chapter boundaries
+        max_part_mb: Split into parts of at most this many megabytes, at chapter boundaries
+    
+    Parts are written next to output_file as <name>_part01.m4a, <name>_part02.m4a, ...
+    and muxed concurrently, each with its own chapter markers, cover and metadata. They are
+    muxed under temporary names and only moved into place, replacing the output of any
+    earlier merge, once all of them succeeded. Returns the written files, or False.
+    """
+    audiobook_path = Path(audiobook_dir)
+    
+    # Find all M4A files and sort them naturally
+    chapter_files = sorted([f for f in audiobook_path.glob("*.m4a") if "Глава_" in f.name], 
+                          key=lambda x: int(x.stem.split('_')[1]))
+    
+    if not chapter_files:
+        print(f"No chapter files found in {audiobook_path}")
+        return False
+    
+    print(f"Found {len(chapter_files)} chapters, merging with ffmpeg...")
+    
+    # Look for cover image
+    cover_image = None
+    for ext in ['.jpeg', '.jpg', '.png']:
+        potential_cover = audiobook_path / f"{audiobook_path.name}{ext}"
+        if potential_cover.exists():
+            cover_image = potential_cover
+            break
+    
+    # Get chapter durations first
+    print("📊 Analyzing chapter durations...")
+    durations = probe_chapter_durations(chapter_files)
+    # Chapters keep their position in the whole book as title, also inside a part
+    chapter_numbers = list(range(1, len(chapter_files) + 1))
+    
+    parts = [list(range(len(chapter_files)))]
+    if max_part_hours or max_part_mb:
+        parts = split_chapters_into_parts(chapter_files, durations, max_part_hours, max_part_mb)
+    
+    if len(parts) == 1:
+        outputs = [Path(output_file)]
+        part_metadata = [metadata]
+        fallback_titles = [audiobook_path.name]
+    else:
+        base_name = Path(output_file).stem.removesuffix('_complete')
+        outputs = [Path(output_file).with_name(f"{base_name}_part{i:02d}{Path(output_file).suffix}")
+                   for i in range(1, len(parts) + 1)]
+        part_metadata = []
+        for i in range(1, len(parts) + 1):
+            if metadata:
+                title = f"{metadata.get('title', audiobook_path.name)}, часть {i}"
+                part_metadata.append({**metadata, 'title': title, 'track': f"{i}/{len(parts)}"})
+            else:
+                part_metadata.append(None)
+        fallback_titles = [f"{audiobook_path.name}, часть {i}" for i in range(1, len(parts) + 1)]
+        print(f"✂️ Splitting into {len(parts)} parts: "
+              + ", ".join(f"{len(p)} ch / {format_duration(sum(durations[i] for i in p))}" for p in parts))
+    
+    temporaries = [output.with_name(f"{output.name}.tmp") for output in outputs]
+    
+    def mux_part(part_index):
+        indices = parts[part_index]
+        return mux_audiobook([chapter_files[i] for i in indices], [durations[i] for i in indices],
+                             [chapter_numbers[i] for i in indices], temporaries[part_index],
+                             part_metadata[part_index], cover_image, fallback_titles[part_index],
+                             temp_suffix=f"_part{part_index + 1:02d}" if len(parts) > 1 else '')
+    
+    # Each part is an independent ffmpeg run, so they are muxed side by side
+    with ThreadPoolExecutor(max_workers=min(len(parts), os.cpu_count() or 1)) as executor:
+        results = list(executor.map(mux_part, range(len(parts))))
+    
+    failed = [(output, result) for output, result in zip(outputs, results) if result.returncode != 0]
+    if failed:
+        for output, result in failed:
+            print(f"❌ Error merging audiobook with ffmpeg: {output.name}")
+            print(result.stderr)
+        for temporary in temporaries:
+            temporary.unlink(missing_ok=True)
+        return False
+    
+    # A re-merge with other split settings must not leave the previous layout behind
+    for existing in map(Path, merged_outputs(output_file)):
+        if existing not in outputs:
+            try:
+                existing.unlink()
+                print(f"🗑️ Removed previous output: {existing.name}")
+            except OSError as e:
+                print(f"⚠️ Could not remove previous output {existing.name}: {e}")
+    for temporary, output in zip(temporaries, outputs):
+        os.replace(temporary, output)
+    # Peers sharing the library go by this marker, not by the outputs, which may be an old merge
+    mark_merged(audiobook_dir, outputs)
+    
+    for output in outputs:
+        print(f"✅ Successfully merged audiobook: {output}")
+        # Get file size
+        size_mb = output.stat().st_size / (1024 * 1024)
+        print(f"Output file size: {size_mb:.1f} MB")
+    if cover_image:
+        print(f"📷 Cover image embedded: {cover_image.name}")
+    print(f"📑 Chapter markers added: {len(chapter_files)} chapters")
+    
+    # Clean up individual chapter files after successful merge (if requested)
+    if cleanup_chapters:
+        with PROFILER.stage('cleanup'):
+            print("🧹 Cleaning up chapter files...")
+            for chapter_file in chapter_files:
+                try:
+                    chapter_file.unlink()
+                    print(f"   Removed: {chapter_file.name}")
+                except OSError as e:
+                    print(f"   ⚠️ Could not remove {chapter_file.name}: {e}")
+        
+        print(f"✨ Cleanup complete. Merged audiobook ready: {', '.join(o.name for o in outputs)}")
+    else:
+        print(f"📁 Chapter files preserved. Merged audiobook ready: {', '.join(o.name for o in outputs)}")
+    
+    return outputs
+
+
+def download_audiobook(uuid, series='', max_bitrate=False, merge_chapters=True, cleanup_chapters=True,
+                       transcode=None, transcode_bitrate='48k', max_part_hours=None, max_part_mb=None,
+                       stream=False, parallel=4):
     path = get_resource_info('audiobook', uuid, series)
     resp = get_resource_json('audiobook', uuid)
-    metadata = None
+    # The merge watcher leaves the book alone until this download, and its own merge, are done
+    with ActivityMarker(os.path.dirname(path), DOWNLOADING_MARKER):
+        metadata = None
     
-    # Extract metadata from the JSON file if it exists
-    json_file = f"{path}.json"
-    metadata = None
-    if os.path.exists(json_file):
-        with open(json_file, 'r', encoding='utf-8') as f:
-            info = json.load(f)
-            if 'audiobook' in info:
-                book_info = info['audiobook']
+        # Extract metadata from the JSON file if it exists
+        json_file = f"{path}.json"
+        metadata = None
+        if os.path.exists(json_file):
+            with open(json_file, 'r', encoding='utf-8') as f:
+                info = json.load(f)
+                if 'audiobook' in info:
+                    book_info = info['audiobook']
                 
-                # Extract author name
-                author_name = 'Unknown Author'
-                if 'authors' in book_info and book_info['authors']:
-                    author_name = book_info['authors'][0].get('name', 'Unknown Author')
+                    # Extract author name
+                    author_name = 'Unknown Author'
+                    if 'authors' in book_info and book_info['authors']:
+                        author_name = book_info['authors'][0].get('name', 'Unknown Author')
                 
-                # Extract narrator name
-                narrator_name = ''
-                if 'narrators' in book_info and book_info['narrators']:
-                    narrator_names = [n.get('name', '') for n in book_info['narrators']]
-                    narrator_name = ', '.join(filter(None, narrator_names))
+                    # Extract narrator name
+                    narrator_name = ''
+                    if 'narrators' in book_info and book_info['narrators']:
+                        narrator_names = [n.get('name', '') for n in book_info['narrators']]
+                        narrator_name = ', '.join(filter(None, narrator_names))
                 
-                # Extract publisher name
-                publisher_name = ''
-                if 'publishers' in book_info and book_info['publishers']:
-                    publisher_name = book_info['publishers'][0].get('name', '')
+                    # Extract publisher name
+                    publisher_name = ''
+                    if 'publishers' in book_info and book_info['publishers']:
+                        publisher_name = book_info['publishers'][0].get('name', '')
                 
-                metadata = {
-                    'title': book_info.get('title', os.path.basename(path)),
-                    'artist': author_name,
-                    'album': book_info.get('title', os.path.basename(path)),
-                    'album_artist': author_name,
-                    'composer': author_name,
-                    'genre': 'Audiobook',
-                    'media_type': '2',
-                    'comment': book_info.get('annotation', ''),
-                    'publisher': publisher_name,
-                    'language': book_info.get('language', 'ru'),
-                }
+                    metadata = {
+                        'title': book_info.get('title', os.path.basename(path)),
+                        'artist': author_name,
+                        'album': book_info.get('title', os.path.basename(path)),
+                        'album_artist': author_name,
+                        'composer': author_name,
+                        'genre': 'Audiobook',
+                        'media_type': '2',
+                        'comment': book_info.get('annotation', ''),
+                        'publisher': publisher_name,
+                        'language': book_info.get('language', 'ru'),
+                    }
                 
-                # Add narrator if available
-                if narrator_name:
-                    metadata['performer'] = narrator_name
+                    # Add narrator if available
+                    if narrator_name:
+                        metadata['performer'] = narrator_name
                 
-                # Remove empty values
-                metadata = {k: v for k, v in metadata.items() if v}
+                    # Remove empty values
+                    metadata = {k: v for k, v in metadata.items() if v}
     
-    if resp:
-        bitrate = 'max_bit_rate' if max_bitrate else 'min_bit_rate'
-        json_data = resp['tracks']
-        files = os.listdir(os.path.dirname(path))
-        for track in json_data:
-            name = f'Глава_{track["number"]+1}.m4a'
-            if name not in files:
-                download_url = track['offline'][bitrate]['url'].replace(".m3u8", ".m4a")
-                asyncio.run(download_file(
-                    download_url, f'{os.path.dirname(path)}/{name}'))
+        if resp:
+            bitrate = 'max_bit_rate' if max_bitrate else 'min_bit_rate'
+            json_data = resp['tracks']
+            with open(f"{path}_playlist.json", 'w', encoding='utf-8') as file:
+                file.write(json.dumps(resp, ensure_ascii=False))
+            transcoder = None
+            transcoded = True
+            if transcode and not ChapterTranscoder.is_available(transcode):
+                print(f"⚠️ ffmpeg with the {TRANSCODE_CODECS[transcode][1]} encoder was not found, "
+                      f"keeping the original encoding")
+            elif transcode:
+                transcoder = ChapterTranscoder(os.path.dirname(path), transcode, transcode_bitrate)
+            files = os.listdir(os.path.dirname(path))
+            PROGRESS.enqueue(sum(1 for track in json_data if f'Глава_{track["number"]+1}.m4a' not in files))
+            try:
+                if stream:
+                    # Listening order first: the opening chapters alone, then the rest in parallel
+                    hls_stream = HlsStream(os.path.dirname(path), [f'Глава_{track["number"]+1}.m4a' for track in json_data])
+                    fetched = asyncio.run(fetch_chapters(uuid, json_data, os.path.dirname(path), bitrate, files, transcoder,
+                                                         hls_stream, parallel=parallel, priority=STREAM_PRIORITY_CHAPTERS))
+                else:
+                    fetched = asyncio.run(fetch_chapters(uuid, json_data, os.path.dirname(path), bitrate, files, transcoder))
+                if transcoder and fetched:
+                    PROGRESS.close()
+                    print("🎛️ Waiting for chapter transcoding to finish...")
+                    transcoded = transcoder.wait()
+            finally:
+                if transcoder:
+                    transcoder.close()
+            PROGRESS.close()
+            if not fetched:
+                print(f"⏭️ {os.path.basename(os.path.dirname(path))} was already completed by another worker")
+                return
+            chapter_names = [f'Глава_{track["number"]+1}.m4a' for track in json_data]
+            if LEASES.enabled:
+                # Chapters claimed elsewhere may exist already while their worker still encodes them
+                wait_for_other_workers(uuid, os.path.dirname(path), chapter_names)
+            if not transcoded or not is_transcoding_consistent(os.path.dirname(path), chapter_names):
+                # Mixed codecs cannot be concatenated; a rerun retries the chapters missing from the list
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(os.path.dirname(path), CHAPTERS_COMPLETE_MARKER))
+                print(f"⚠️ Some chapters could not be transcoded, so the book was not merged. "
+                      f"Chapters are kept in {os.path.dirname(path)}; run the download again with --transcode to retry them")
+                return
+            with open(os.path.join(os.path.dirname(path), CHAPTERS_COMPLETE_MARKER), 'w', encoding='utf-8') as file:
+                file.write(str(len(json_data)))
+        PROGRESS.close()
     
-    # Skip merging if requested
-    if not merge_chapters:
-        print(f"📁 Audiobook chapters saved separately in: {os.path.dirname(path)}")
-        return
+        # Skip merging if requested
+        if not merge_chapters:
+            print(f"📁 Audiobook chapters saved separately in: {os.path.dirname(path)}")
+            return
     
-    # Try ffmpeg first, fallback to pydub if ffmpeg fails
-    output_file = f"{path}_complete.m4a"
-    audiobook_dir = os.path.dirname(path)
+        # Try ffmpeg first, fallback to pydub if ffmpeg fails
+        output_file = f"{path}_complete.m4a"
+        audiobook_dir = os.path.dirname(path)
     
+        # Only one of the workers that shared the download merges the book
+        with LEASES.claim(merge_key(audiobook_dir)) as claimed:
+            if not claimed:
+                print(f"⏭️ Another worker is merging {os.path.basename(audiobook_dir)}")
+                return
+            if LEASES.enabled and os.path.exists(os.path.join(audiobook_dir, MERGED_MARKER)):
+                print(f"⏭️ {os.path.basename(audiobook_dir)} was already merged by another worker")
+                return
+            merge_audiobook_with_fallback(path, audiobook_dir, output_file, metadata, cleanup_chapters,
+                                          max_part_hours, max_part_mb)
+
+
+def merge_audiobook_with_fallback(path, audiobook_dir, output_file, metadata, cleanup_chapters,
+                                  max_part_hours, max_part_mb):
     # Check if ffmpeg is available and try to merge
     try:
-        success = merge_audiobook_chapters_ffmpeg(audiobook_dir, output_file, metadata, cleanup_chapters=cleanup_chapters)
-        if success:
-            print(f"Merged audiobook saved to {output_file}")
+        outputs = merge_audiobook_chapters_ffmpeg(audiobook_dir, output_file, metadata, cleanup_chapters=cleanup_chapters,
+                                                   max_part_hours=max_part_hours, max_part_mb=max_part_mb)
+        if outputs:
+            print(f"Merged audiobook saved to {', '.join(map(str, outputs))}")
             return
     except (subprocess.CalledProcessError, FileNotFoundError) as e:
         print(f"ffmpeg not available or failed: {e}")
@@ -483,16 +1287,18 @@ def download_audiobook(uuid, series='', max_bitrate=False, merge_chapters=True,
         print(f"Merged audiobook saved to {path}.m4a")
 
 
+@exclusive('comicbook')
 def download_comicbook(uuid, series=''):
     path = get_resource_info('comicbook', uuid, series)
     resp = get_resource_json('comicbook', uuid)
     if resp:
         download_url = resp["uris"]["zip"]
         asyncio.run(download_file(download_url, f'{path}.cbr'))
-        with zipfile.ZipFile(f'{path}.cbr', 'r') as zip_ref:
-            zip_ref.extractall(os.path.dirname(path))
-        shutil.rmtree(os.path.dirname(path)+"/preview",
-                      ignore_errors=False, onerror=None)
+        with PROFILER.stage('unpack'):
+            with zipfile.ZipFile(f'{path}.cbr', 'r') as zip_ref:
+                zip_ref.extractall(os.path.dirname(path))
+            shutil.rmtree(os.path.dirname(path)+"/preview",
+                          ignore_errors=False, onerror=None)
         create_pdf_from_images(os.path.dirname(path), f"{path}.pdf")
 
 
@@ -500,12 +1306,29 @@ def download_serial(uuid):
     path = get_resource_info('book', uuid)
     resp = get_resource_json('serial', uuid)
     if resp:
-        for episode_index, episode in enumerate(resp["episodes"]):
-            name = f"{episode_index+1}. {episode['title']}"
-            download_dir = f'{os.path.dirname(path)}/{name}'
-            os.makedirs(download_dir, exist_ok=True)
-            download_book(episode['uuid'],
-                          serial_path=f'{download_dir}/{name}')
+        PROGRESS.enqueue(len(resp["episodes"]))
+        # Episodes are converted in worker processes while the next ones download
+        with ProcessPoolExecutor() as executor:
+            conversions = []
+            for episode_index, episode in enumerate(resp["episodes"]):
+                name = f"{episode_index+1}. {episode['title']}"
+                download_dir = f'{os.path.dirname(path)}/{name}'
+                os.makedirs(download_dir, exist_ok=True)
+                if LEASES.enabled and os.path.exists(f'{download_dir}/{name}.epub'):
+                    # Another worker sharing the serial already fetched this episode
+                    PROGRESS.enqueue(-1)
+                    continue
+                conversion = download_book(episode['uuid'],
+                                           serial_path=f'{download_dir}/{name}',
+                                           executor=executor)
+                if conversion:
+                    conversions.append(conversion)
+            PROGRESS.close()
+            # Workers' CPU time is only accounted once the pool has shut down
+            with PROFILER.stage('epub to fb2 (pool)'):
+                for conversion in as_completed(conversions):
+                    conversion.result()
+                executor.shutdown()
 
 
 def download_series(uuid):
@@ -519,6 +1342,13 @@ def download_series(uuid):
         func(part['resource']['uuid'], f"{name}/{part_index+1}. ")
 
 
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
+
 def main():
     argparser = argparse.ArgumentParser()
     argparser.add_argument("command", choices=FUNCTION_MAP.keys())
@@ -526,15 +1356,39 @@ def main():
     argparser.add_argument("--max_bitrate", action='store_false', help="Use maximum bitrate for audiobooks")
     argparser.add_argument("--no-merge", action='store_true', help="Keep audiobook chapters as separate files (don't merge)")
     argparser.add_argument("--keep-chapters", action='store_true', help="Keep individual chapter files after merging")
+    argparser.add_argument("--transcode", choices=TRANSCODE_CODECS.keys(), help="Re-encode audiobook chapters to a compact codec while downloading (aac-he needs ffmpeg built with libfdk_aac)")
+    argparser.add_argument("--transcode-bitrate", default='48k', help="Target bitrate for --transcode (default: 48k)")
+    argparser.add_argument("--split-hours", type=float, help="Split long audiobooks into parts of at most this many hours (at chapter boundaries)")
+    argparser.add_argument("--split-mb", type=float, help="Split long audiobooks into parts of at most this many megabytes (at chapter boundaries)")
+    argparser.add_argument("--stream", action='store_true', help="Play while downloading: fetch the first chapters first and keep a growing HLS playlist in the audiobook's stream/ folder")
+    argparser.add_argument("--parallel", type=positive_int, default=4, help="Chapters downloaded at once by --stream after the first ones (default: 4)")
+    argparser.add_argument("--shared", action='store_true', help="Coordinate with other workers (processes or hosts) writing to the same mybooks/ through lease files")
+    argparser.add_argument("--lease-dir", default=LEASE_DIR, help=f"Directory for the lease files of --shared (default: {LEASE_DIR})")
+    argparser.add_argument("--worker-id", help="Name of this worker in lease files (default: host:pid)")
+    argparser.add_argument("--profile", action='store_true', help="Print wall time, CPU time and peak RSS per pipeline stage at the end")
+    argparser.add_argument("--profile-stage", help="Also run this stage (e.g. 'ffmpeg concat', 'epub to fb2') under cProfile and dump its stats")
+    argparser.add_argument("--profile-output", help="File for the cProfile stats of --profile-stage (default: profile_<stage>.pstats)")
     args = argparser.parse_args()
 
+    if args.profile or args.profile_stage:
+        PROFILER.enable(args.profile_stage, args.profile_output)
+
+    if args.shared:
+        LEASES.enable(args.lease_dir, args.worker_id)
+
     HEADERS['auth-token'] = get_auth_token()
 
     func = FUNCTION_MAP[args.command]
     if args.command == 'audiobook':
-        func(args.uuid, max_bitrate=args.max_bitrate, merge_chapters=not args.no_merge, cleanup_chapters=not args.keep_chapters)
+        func(args.uuid, max_bitrate=args.max_bitrate, merge_chapters=not args.no_merge, cleanup_chapters=not args.keep_chapters,
+             transcode=args.transcode, transcode_bitrate=args.transcode_bitrate,
+             max_part_hours=args.split_hours, max_part_mb=args.split_mb,
+             stream=args.stream, parallel=args.parallel)
     else:
         func(args.uuid)
+    PROGRESS.close()
+    LEASES.close()
+    PROFILER.report()
 
 
 FUNCTION_MAP = {
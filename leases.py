@@ -0,0 +1,307 @@
+"""
+Lease files and audiobook marker files that let several downloader and merger processes,
+on one or more hosts, share a mybooks/ library without working on the same resource at
+the same time
+"""
+
+import contextlib
+import glob
+import json
+import os
+import random
+import re
+import socket
+import sys
+import threading
+import time
+
+LEASE_DIR = "mybooks/.leases"
+# A lease that has not been renewed for this many seconds is considered abandoned
+LEASE_TTL = 60
+
+# Files the downloader leaves in an audiobook directory for merge_audiobook.py and for
+# other workers sharing the library:
+# written once every chapter is downloaded (and transcoded, with --transcode)
+CHAPTERS_COMPLETE_MARKER = ".chapters_complete"
+# chapters already re-encoded, one per line, so a resumed download does not encode them twice
+TRANSCODED_LIST = ".transcoded"
+# present while chapters are being re-encoded, one per worker, suffixed with host and pid
+TRANSCODING_MARKER = ".transcoding"
+# present while the downloader fetches a book and merges it itself, unless it runs with --no-merge
+DOWNLOADING_MARKER = ".downloading"
+# written by whichever process merged the book, after every output is in place and before
+# the chapters are removed; lists the merged files
+MERGED_MARKER = ".merged"
+
+
+def merge_key(audiobook_dir):
+    # Parent and directory name identify a book on every host, whatever the mount point
+    audiobook_dir = os.path.normpath(os.path.abspath(audiobook_dir))
+    return f"merge-{os.path.basename(os.path.dirname(audiobook_dir))}-{os.path.basename(audiobook_dir)}"
+
+
+def is_transcoding_consistent(audiobook_dir, chapter_names):
+    """Whether either none or all of the chapters were re-encoded, so that they can be concatenated"""
+    transcoded_list = os.path.join(audiobook_dir, TRANSCODED_LIST)
+    if not os.path.exists(transcoded_list):
+        return True
+    with open(transcoded_list, encoding='utf-8') as file:
+        transcoded = {line.split()[0] for line in file if line.strip()}
+    return set(chapter_names) <= transcoded
+
+
+def merged_outputs(output_file):
+    """Existing merged files of the book `output_file` (<name>_complete.m4a) belongs to, in any layout"""
+    output_file = os.fspath(output_file)
+    directory, name = os.path.split(output_file)
+    stem, suffix = os.path.splitext(name)
+    pattern = re.compile(rf"{re.escape(stem.removesuffix('_complete'))}(_complete|_part\d+){re.escape(suffix)}")
+    return sorted(os.path.join(directory, entry) for entry in os.listdir(directory or '.') if pattern.fullmatch(entry))
+
+
+def mark_merged(audiobook_dir, outputs):
+    with open(os.path.join(audiobook_dir, MERGED_MARKER), 'w', encoding='utf-8') as file:
+        file.write(''.join(f"{os.path.basename(output)}\n" for output in outputs))
+
+
+def is_book_finished(audiobook_dir):
+    """Whether the book was merged, or all its chapters were downloaded, so that its chapters may be gone"""
+    return os.path.exists(os.path.join(audiobook_dir, MERGED_MARKER)) \
+        or os.path.exists(os.path.join(audiobook_dir, CHAPTERS_COMPLETE_MARKER))
+
+
+def read_record(path):
+    """Owner record of a lease file; None if the file is gone, {} while it is being written"""
+    try:
+        with open(path, encoding='utf-8') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError):
+        return {}
+
+
+def is_abandoned(path, record, ttl=LEASE_TTL):
+    """Whether the owner of a lease file stopped renewing it or its process on this host is gone"""
+    try:
+        age = time.time() - os.path.getmtime(path)
+    except FileNotFoundError:
+        return True
+    if age > ttl:
+        return True
+    # os.kill(pid, 0) only probes a process on POSIX; on Windows it sends CTRL_C_EVENT,
+    # so there the TTL alone decides
+    if sys.platform != 'win32' and record and record.get('host') == socket.gethostname() and record.get('pid'):
+        try:
+            os.kill(record['pid'], 0)
+        except ProcessLookupError:
+            return True
+        except OSError:
+            pass
+    return False
+
+
+class LeaseManager:
+    """
+    Claim resources through lease files in a directory on the shared file system
+
+    Every claim of a key creates a new generation file `<key>.<n>.lease` with O_EXCL and
+    then lists the generations again: it holds the key only if no other live generation
+    exists besides the abandoned ones it read before creating its own. Two claimants can
+    therefore both back off, but never both win, and a live lease is never moved or
+    deleted by anyone but its owner. The owner renews its file from a heartbeat thread by
+    touching it; a generation that was not touched for `ttl` seconds, or whose owner
+    process on this host is gone, is abandoned and removed by the next successful claimant.
+    An owner whose lease was superseded notices it on the next heartbeat; `holds()` then
+    returns False. When disabled every claim succeeds, so callers do not need to check
+    whether coordination is on.
+    """
+
+    def __init__(self, lease_dir=LEASE_DIR, worker_id=None, ttl=LEASE_TTL, enabled=False):
+        self.lease_dir = lease_dir
+        self.host = socket.gethostname()
+        self.worker_id = worker_id or f"{self.host}:{os.getpid()}"
+        self.ttl = ttl
+        self.enabled = enabled
+        self.held = {}  # key -> path of our generation file
+        self.lock = threading.Lock()
+        self.heartbeat = None
+        self.stopped = threading.Event()
+
+    def enable(self, lease_dir=None, worker_id=None):
+        self.lease_dir = lease_dir or self.lease_dir
+        self.worker_id = worker_id or self.worker_id
+        self.enabled = True
+        os.makedirs(self.lease_dir, exist_ok=True)
+
+    def _base(self, key):
+        return re.sub(r'[\\/:*?"<>|\s]+', '_', key)
+
+    def _generations(self, key):
+        """Existing generation files of `key` as {generation: path}"""
+        pattern = re.compile(re.escape(self._base(key)) + r'\.(\d+)\.lease$')
+        generations = {}
+        for name in os.listdir(self.lease_dir):
+            match = pattern.match(name)
+            if match:
+                generations[int(match.group(1))] = os.path.join(self.lease_dir, name)
+        return generations
+
+    def _live(self, generations, exclude=()):
+        live = {}
+        for generation, path in generations.items():
+            if path in exclude:
+                continue
+            record = read_record(path)
+            if record is not None and not is_abandoned(path, record, self.ttl):
+                live[generation] = path
+        return live
+
+    def try_acquire(self, key, attempts=3):
+        """Claim `key` for this worker; returns False if another worker holds it"""
+        if not self.enabled:
+            return True
+        with self.lock:
+            if key in self.held:
+                return True
+        for _ in range(attempts):
+            generations = self._generations(key)
+            if self._live(generations):
+                return False
+            abandoned = set(generations.values())
+            path = os.path.join(self.lease_dir, f"{self._base(key)}.{max(generations, default=0) + 1}.lease")
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                # Another claimant took the same generation first
+                return False
+            with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                json.dump({'owner': self.worker_id, 'host': self.host, 'pid': os.getpid(),
+                           'acquired': time.time()}, file)
+            # Whoever created a competing generation meanwhile is visible now
+            if self._live(self._generations(key), exclude=abandoned | {path}):
+                os.remove(path)
+                # Both sides may have backed off; try again after a random pause
+                time.sleep(random.uniform(0.05, 0.5))
+                continue
+            for stale_path in abandoned:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(stale_path)
+            with self.lock:
+                self.held[key] = path
+                self._start_heartbeat()
+            return True
+        return False
+
+    def holds(self, key):
+        """Whether this worker still holds `key` (always True when disabled)"""
+        if not self.enabled:
+            return True
+        with self.lock:
+            return key in self.held
+
+    def release(self, key):
+        if not self.enabled:
+            return
+        with self.lock:
+            path = self.held.pop(key, None)
+        if path:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+
+    def is_held_elsewhere(self, key):
+        """Whether another live worker currently holds `key`"""
+        if not self.enabled:
+            return False
+        with self.lock:
+            own = self.held.get(key)
+        return bool(self._live(self._generations(key), exclude={own}))
+
+    @contextlib.contextmanager
+    def claim(self, key):
+        acquired = self.try_acquire(key)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                self.release(key)
+
+    def _start_heartbeat(self):
+        if self.heartbeat is None:
+            self.heartbeat = threading.Thread(target=self._renew, name="lease-heartbeat", daemon=True)
+            self.heartbeat.start()
+
+    def _renew(self):
+        while not self.stopped.wait(self.ttl / 3):
+            with self.lock:
+                held = dict(self.held)
+            for key, path in held.items():
+                generations = self._generations(key)
+                own = max((g for g, p in generations.items() if p == path), default=None)
+                superseded = own is None or any(g > own for g in generations)
+                if not superseded:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.utime(path)
+                    continue
+                print(f"⚠️ Lease {key} was lost to another worker")
+                with self.lock:
+                    if self.held.get(key) == path:
+                        del self.held[key]
+                # Only our own generation is removed; the new holder keeps its own
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+
+    def close(self):
+        """Stop renewing and release every lease still held"""
+        self.stopped.set()
+        with self.lock:
+            held = list(self.held)
+        for key in held:
+            self.release(key)
+
+
+class ActivityMarker:
+    """
+    A `<prefix>.<host>.<pid>` file announcing that this process is working in `directory`
+
+    The file is touched from a heartbeat thread, so `live_markers()` can tell it from a
+    marker left behind by a crashed process under the same TTL and liveness rules as leases.
+    """
+
+    def __init__(self, directory, prefix, ttl=LEASE_TTL):
+        self.host = socket.gethostname()
+        self.path = os.path.join(directory, f"{prefix}.{self.host}.{os.getpid()}")
+        self.ttl = ttl
+        with open(self.path, 'w', encoding='utf-8') as file:
+            json.dump({'host': self.host, 'pid': os.getpid()}, file)
+        self.stopped = threading.Event()
+        self.heartbeat = threading.Thread(target=self._renew, name="marker-heartbeat", daemon=True)
+        self.heartbeat.start()
+
+    def _renew(self):
+        while not self.stopped.wait(self.ttl / 3):
+            with contextlib.suppress(FileNotFoundError):
+                os.utime(self.path)
+
+    def close(self):
+        self.stopped.set()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def live_markers(directory, prefix, ttl=LEASE_TTL, exclude=None):
+    """Activity markers with `prefix` in `directory` whose owners are still alive"""
+    live = []
+    for path in glob.glob(os.path.join(glob.escape(str(directory)), f"{prefix}.*")):
+        if path == exclude:
+            continue
+        record = read_record(path)
+        if record is not None and not is_abandoned(path, record, ttl):
+            live.append(path)
+    return live
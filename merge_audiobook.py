@@ -8,6 +8,15 @@ import subprocess
 import json
 from pathlib import Path
 import sys
+import time
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from leases import (CHAPTERS_COMPLETE_MARKER, DOWNLOADING_MARKER, LEASE_DIR, TRANSCODING_MARKER,
+                    LeaseManager, is_transcoding_consistent, live_markers, mark_merged, merge_key, merged_outputs)
+
+# Coordinates workers sharing one library; disabled (every claim succeeds) unless --shared
+LEASES = LeaseManager()
 
 def merge_audiobook_chapters(audiobook_path, cleanup_chapters=True):
     """
@@ -78,8 +87,9 @@ def merge_audiobook_chapters(audiobook_path, cleanup_chapters=True):
                 # Remove empty values
                 metadata = {k: v for k, v in metadata.items() if v}
     
-    # Create output filename
+    # Create output filename; ffmpeg writes a temporary file that replaces it only on success
     output_file = audiobook_dir / f"{audiobook_dir.name}_complete.m4a"
+    temporary_file = output_file.with_name(f"{output_file.name}.tmp")
     
     # Look for cover image
     cover_image = None
@@ -181,12 +191,24 @@ def merge_audiobook_chapters(audiobook_path, cleanup_chapters=True):
             cmd.extend(['-metadata', 'genre=Audiobook'])
             cmd.extend(['-metadata', 'media_type=2'])
         
-        cmd.append(str(output_file))
+        # ffmpeg picks its ipod muxer for .m4a, which cannot hold chapters transcoded to Opus
+        cmd.extend(['-f', 'mp4'])
+        cmd.append(str(temporary_file))
         
         # Run ffmpeg
         result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8', errors='replace')
         
         if result.returncode == 0:
+            # Parts of an earlier split merge (RUBookmatedownloader.py --split-hours) would be a second copy
+            for existing in map(Path, merged_outputs(output_file)):
+                if existing != output_file:
+                    try:
+                        existing.unlink()
+                        print(f"🗑️ Removed previous output: {existing.name}")
+                    except OSError as e:
+                        print(f"⚠️ Could not remove previous output {existing.name}: {e}")
+            os.replace(temporary_file, output_file)
+            mark_merged(audiobook_dir, [output_file])
             print(f"✅ Successfully merged audiobook: {output_file}")
             print(f"Original chapters: {len(chapter_files)} files")
             
@@ -225,6 +247,163 @@ def merge_audiobook_chapters(audiobook_path, cleanup_chapters=True):
             filelist_path.unlink()
         if chapters_metadata_path.exists():
             chapters_metadata_path.unlink()
+        if temporary_file.exists():
+            temporary_file.unlink()
+
+def is_audiobook_complete(audiobook_dir):
+    """
+    Check whether every chapter of an audiobook has been downloaded
+
+    A directory is complete when the downloader left its completion marker in it,
+    or when each track of the saved playlist has its chapter file. Chapters that are
+    still being transcoded do not count, unless the process transcoding them is gone,
+    and neither does a book whose transcoding stopped halfway: its codecs would not
+    concatenate.
+    """
+    audiobook_dir = Path(audiobook_dir)
+    if live_markers(audiobook_dir, TRANSCODING_MARKER):
+        return False
+    if (audiobook_dir / CHAPTERS_COMPLETE_MARKER).exists():
+        return True
+    for playlist_file in audiobook_dir.glob("*_playlist.json"):
+        try:
+            with open(playlist_file, 'r', encoding='utf-8') as f:
+                tracks = json.load(f)['tracks']
+        except (OSError, ValueError, KeyError):
+            # Playlist is still being written
+            continue
+        chapter_names = [f"Глава_{track['number'] + 1}.m4a" for track in tracks]
+        if tracks and all((audiobook_dir / name).exists() for name in chapter_names) \
+                and is_transcoding_consistent(audiobook_dir, chapter_names):
+            return True
+    return False
+
+
+def merge_audiobook_exclusively(audiobook_path, cleanup_chapters=True):
+    """Merge unless another worker sharing the library is merging the same audiobook"""
+    with LEASES.claim(merge_key(audiobook_path)) as claimed:
+        if not claimed:
+            print(f"⏭️  Skipping {Path(audiobook_path).name} (another worker is merging it)")
+            return None
+        return merge_audiobook_chapters(audiobook_path, cleanup_chapters=cleanup_chapters)
+
+
+def is_merged(audiobook_dir):
+    # RUBookmatedownloader.py --split-hours/--split-mb writes _part01.m4a, ... instead of _complete.m4a
+    audiobook_dir = Path(audiobook_dir)
+    return (audiobook_dir / f"{audiobook_dir.name}_complete.m4a").exists() \
+        or (audiobook_dir / f"{audiobook_dir.name}_part01.m4a").exists()
+
+
+def is_watched_file(path):
+    # Only chapters and completion hints can make a book ready; ignoring everything
+    # else keeps the merger from reacting to its own output
+    name = Path(path).name
+    return (name.startswith("Глава_") and name.endswith(".m4a")) \
+        or name == CHAPTERS_COMPLETE_MARKER or name.startswith((TRANSCODING_MARKER, DOWNLOADING_MARKER)) \
+        or name.endswith("_playlist.json")
+
+
+def watch_audiobooks(library_dir, workers=None, force=False, cleanup_chapters=True, settle=2.0, poll=False):
+    """
+    Watch a library directory and merge each audiobook as soon as its chapters are complete
+
+    Args:
+        library_dir: Directory to watch recursively (e.g. mybooks/audiobook)
+        workers: Number of audiobooks merged at the same time
+        force: Merge again even if a merged file already exists
+        cleanup_chapters: Whether to remove individual chapter files after successful merge
+        settle: Seconds without new events before a directory is checked
+        poll: Poll the file system instead of using inotify (needed for network mounts)
+    """
+    try:
+        from watchdog.events import FileSystemEventHandler
+        from watchdog.observers import Observer
+        from watchdog.observers.polling import PollingObserver
+    except ImportError:
+        print("❌ Watch mode requires watchdog: pip install watchdog")
+        return
+
+    library_dir = Path(library_dir)
+    if not library_dir.exists():
+        print(f"❌ {library_dir} directory not found")
+        return
+
+    lock = threading.Lock()
+    pending = {}  # audiobook directory -> time of the last event in it
+    in_progress = set()
+    merged = set()
+
+    class ChapterEventHandler(FileSystemEventHandler):
+        def on_any_event(self, event):
+            if event.is_directory:
+                return
+            # Chapters are renamed into place when their download finishes
+            for path in (event.src_path, getattr(event, 'dest_path', '')):
+                if path and is_watched_file(path):
+                    with lock:
+                        pending[Path(path).parent] = time.monotonic()
+
+    def merge(audiobook_dir):
+        try:
+            print(f"\n📚 Processing: {audiobook_dir.name}")
+            if merge_audiobook_exclusively(str(audiobook_dir), cleanup_chapters=cleanup_chapters):
+                with lock:
+                    merged.add(audiobook_dir)
+        except OSError as e:
+            print(f"❌ Could not merge {audiobook_dir.name}: {e}")
+        except Exception:
+            # The executor would otherwise keep the error in a future nobody reads
+            print(f"❌ Could not merge {audiobook_dir.name}:")
+            traceback.print_exc()
+        finally:
+            with lock:
+                in_progress.discard(audiobook_dir)
+
+    def submit_if_complete(executor, audiobook_dir):
+        with lock:
+            if audiobook_dir in in_progress or audiobook_dir in merged:
+                return
+            if LEASES.is_held_elsewhere(merge_key(audiobook_dir)):
+                # Checked again when the other worker's output or cleanup triggers events
+                return
+            if live_markers(audiobook_dir, DOWNLOADING_MARKER):
+                # The downloader merges this book itself; its marker going away triggers a recheck
+                return
+            if is_merged(audiobook_dir) and not force:
+                return
+            if not is_audiobook_complete(audiobook_dir):
+                return
+            in_progress.add(audiobook_dir)
+        executor.submit(merge, audiobook_dir)
+
+    observer = PollingObserver() if poll else Observer()
+    observer.schedule(ChapterEventHandler(), str(library_dir), recursive=True)
+    observer.start()
+    print(f"👀 Watching {library_dir} for completed audiobooks (Ctrl+C to stop)")
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        # Pick up books that were completed while nobody was watching
+        for hint in library_dir.rglob("*"):
+            if hint.is_file() and is_watched_file(hint):
+                with lock:
+                    pending.setdefault(hint.parent, 0.0)
+        try:
+            while True:
+                now = time.monotonic()
+                with lock:
+                    ready = [d for d, last_event in pending.items() if now - last_event >= settle]
+                    for audiobook_dir in ready:
+                        del pending[audiobook_dir]
+                for audiobook_dir in ready:
+                    submit_if_complete(executor, audiobook_dir)
+                time.sleep(0.5)
+        except KeyboardInterrupt:
+            print("\n⏹️  Stopping, waiting for running merges to finish...")
+        finally:
+            observer.stop()
+            observer.join()
+
 
 def main():
     import argparse
@@ -234,12 +413,25 @@ def main():
     parser.add_argument('--batch', action='store_true', help='Process all audiobooks in mybooks/audiobook/ directory')
     parser.add_argument('--force', action='store_true', help='Overwrite existing merged files')
     parser.add_argument('--keep-chapters', action='store_true', help='Keep individual chapter files after merging')
+    parser.add_argument('--watch', action='store_true', help='Watch mybooks/audiobook/ (or the given directory) and merge audiobooks as soon as all chapters are downloaded')
+    parser.add_argument('--workers', type=int, help='Number of audiobooks merged at the same time in watch mode (default: number of CPUs)')
+    parser.add_argument('--poll', action='store_true', help='Poll for changes instead of using inotify (for network mounts written by other machines)')
+    parser.add_argument('--shared', action='store_true', help='Coordinate with other workers (processes or hosts) sharing the library through lease files')
+    parser.add_argument('--lease-dir', default=LEASE_DIR, help=f'Directory for the lease files of --shared (default: {LEASE_DIR})')
+    parser.add_argument('--worker-id', help='Name of this worker in lease files (default: host:pid)')
     args = parser.parse_args()
     
+    if args.shared:
+        LEASES.enable(args.lease_dir, args.worker_id)
+    
     print("🎧 Audiobook Chapter Merger")
     print("=" * 50)
     
-    if args.batch:
+    if args.watch:
+        watch_audiobooks(args.audiobook_path or "mybooks/audiobook", workers=args.workers, force=args.force,
+                         cleanup_chapters=not args.keep_chapters, poll=args.poll)
+        
+    elif args.batch:
         # Process all audiobooks in the mybooks/audiobook directory
         audiobooks_dir = Path("mybooks/audiobook")
         if not audiobooks_dir.exists():
@@ -255,15 +447,13 @@ def main():
         successful = 0
         
         for audiobook_dir in audiobook_dirs:
-            output_file = audiobook_dir / f"{audiobook_dir.name}_complete.m4a"
-            
             # Skip if already merged and not forcing
-            if output_file.exists() and not args.force:
+            if is_merged(audiobook_dir) and not args.force:
                 print(f"⏭️  Skipping {audiobook_dir.name} (already merged, use --force to overwrite)")
                 continue
             
             print(f"\n📚 Processing: {audiobook_dir.name}")
-            merged_file = merge_audiobook_chapters(str(audiobook_dir), cleanup_chapters=not args.keep_chapters)
+            merged_file = merge_audiobook_exclusively(str(audiobook_dir), cleanup_chapters=not args.keep_chapters)
             if merged_file:
                 successful += 1
         
@@ -277,7 +467,7 @@ def main():
             audiobook_path = input("Enter the path to the audiobook directory: ").strip()
         
         if os.path.exists(audiobook_path):
-            merged_file = merge_audiobook_chapters(audiobook_path, cleanup_chapters=not args.keep_chapters)
+            merged_file = merge_audiobook_exclusively(audiobook_path, cleanup_chapters=not args.keep_chapters)
             if merged_file:
                 print(f"\n📱 Transfer this file to your iPhone: {merged_file}")
         else: